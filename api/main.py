@@ -1,35 +1,108 @@
+import asyncio
+import gzip
+import hashlib
+import itertools
 import os
+import re
 import textwrap
-from typing import Optional
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, Callable, Optional
 
 from fastapi import FastAPI, Request, Form
-from fastapi.responses import HTMLResponse, JSONResponse
-from pydantic import BaseModel
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipMiddleware, GZipResponder
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, model_validator
 from jinja2 import Template
 from dotenv import load_dotenv
+import orjson
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
 
+import google.ai.generativelanguage as glm
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+from google.api_core import gapic_v1
+
+# uvicorn[standard] already picks uvloop when it starts the server; runtimes
+# that import the app directly (Vercel) would otherwise get the default loop
+try:
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    # uvloop doesn't ship for Windows
+    pass
 
 # Load environment variables from .env file
 load_dotenv()
 
 # ---- Config ----
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-if not GEMINI_API_KEY:
+# Optional comma-separated list; each key brings its own per-minute quota
+GEMINI_API_KEYS = [k.strip() for k in os.getenv("GEMINI_API_KEYS", "").split(",") if k.strip()]
+if GEMINI_API_KEY and GEMINI_API_KEY not in GEMINI_API_KEYS:
+    GEMINI_API_KEYS.append(GEMINI_API_KEY)
+if not GEMINI_API_KEYS:
     # On Vercel, set the environment variable in the dashboard
     # Locally, put it in a .env and `export $(cat .env | xargs)`
     raise RuntimeError("GEMINI_API_KEY is not set")
 
-genai.configure(api_key=GEMINI_API_KEY)
+# How long a key that hit its quota is skipped by the pool
+KEY_COOLDOWN_SECONDS = float(os.getenv("GEMINI_KEY_COOLDOWN_SECONDS", "30"))
 
 # Choose a fast, inexpensive model for responsive UX
 # You can swap to 'gemini-1.5-pro' if you want higher quality/cost.
-model = genai.GenerativeModel("gemini-1.5-flash")
+MODEL_NAME = "gemini-1.5-flash"
 
-app = FastAPI(title="Story Agent (Prompt → Story)")
+# Stories are ~600–800 words (~1.1k tokens with title and markers); capping the
+# output well below the model default bounds decode time and cost
+GENERATION_CONFIG = genai.types.GenerationConfig(
+    max_output_tokens=1600,
+    temperature=0.8,
+    top_p=0.95,
+    candidate_count=1,
+)
+
+# Cap on Gemini generations in flight per process; extra requests queue
+MAX_CONCURRENT_LLM = int(os.getenv("MAX_CONCURRENT_LLM", "16"))
+
+# Finished /generate results kept per process, keyed by normalized (tone, inspiration)
+STORY_CACHE_SIZE = int(os.getenv("STORY_CACHE_SIZE", "1024"))
+# Raw stories kept so /revise can refer to them by id instead of re-uploading
+STORY_STORE_SIZE = int(os.getenv("STORY_STORE_SIZE", "4096"))
+
+app = FastAPI(title="Story Agent (Prompt → Story)", default_response_class=ORJSONResponse)
+
+class StreamFriendlyGZipResponder(GZipResponder):
+    """
+    GZip for regular responses. Server-Sent Events pass through untouched:
+    gzip holds small writes back until it has a full block, which would stall
+    the frames.
+    """
+    passthrough = False
+
+    async def send_with_gzip(self, message):
+        if message["type"] == "http.response.start":
+            content_type = Headers(raw=message["headers"]).get("content-type", "")
+            self.passthrough = content_type.startswith("text/event-stream")
+        if self.passthrough:
+            await self.send(message)
+            return
+        await super().send_with_gzip(message)
+
+class StreamFriendlyGZipMiddleware(GZipMiddleware):
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and "gzip" in Headers(scope=scope).get("accept-encoding", ""):
+            responder = StreamFriendlyGZipResponder(self.app, self.minimum_size, compresslevel=self.compresslevel)
+            await responder(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
+
+app.add_middleware(StreamFriendlyGZipMiddleware, minimum_size=512, compresslevel=5)
 
 # ---- HTML (simple, no build step) ----
-INDEX_HTML = Template("""
+# The page takes no variables, so render it once at import
+INDEX_HTML: str = Template("""
 <!doctype html>
 <html>
 <head>
@@ -101,6 +174,54 @@ INDEX_HTML = Template("""
 const genBtn = document.getElementById('btn-generate');
 const reviseBtn = document.getElementById('btn-revise');
 const resetBtn = document.getElementById('btn-reset');
+let storyId = null;
+
+async function readEvents(res, onEvent){
+  // Minimal Server-Sent Events reader over fetch (EventSource can't POST)
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buf = '';
+  for(;;){
+    const { value, done } = await reader.read();
+    if(done) break;
+    buf += decoder.decode(value, { stream:true });
+    let i;
+    while((i = buf.indexOf('\\n\\n')) !== -1){
+      const frame = buf.slice(0, i);
+      buf = buf.slice(i + 2);
+      if(frame.startsWith('data: ')) onEvent(JSON.parse(frame.slice(6)));
+    }
+  }
+}
+
+function storyStreamer(titleEl, storyEl){
+  // Buffer until the "Story:" marker, then append the rest straight into the DOM.
+  // Text from a trailing "[" is held back so half-received [TWIST#] markers never flash.
+  let head = '';
+  let pending = '';
+  let inStory = false;
+  return function(delta){
+    if(!inStory){
+      head += delta;
+      const t = head.match(/^\\s*title:[ \\t]*(.*)$/im);
+      if(t) titleEl.textContent = t[1].trim();
+      const s = head.match(/^\\s*story:[^\\n]*\\n/im);
+      if(!s) return;
+      inStory = true;
+      delta = head.slice(s.index + s[0].length);
+    }
+    pending += delta;
+    let ready = pending;
+    const cut = pending.lastIndexOf('[');
+    if(cut !== -1 && pending.indexOf(']', cut) === -1){
+      ready = pending.slice(0, cut);
+      pending = pending.slice(cut);
+    } else {
+      pending = '';
+    }
+    storyEl.append(ready.replace(/\\[TWIST\\d+\\]/g, ''));
+  };
+}
 
 async function generateStory(){
   const inspiration = document.getElementById('inspiration').value.trim();
@@ -108,34 +229,68 @@ async function generateStory(){
   if(!inspiration){ alert('Give me some inspiration.'); return; }
   genBtn.disabled = true; genBtn.textContent = 'Generating...';
 
-  const res = await fetch('/generate', {
-    method:'POST',
-    headers:{'Content-Type':'application/json'},
-    body: JSON.stringify({ inspiration, tone })
-  });
-  const data = await res.json();
-  genBtn.disabled = false; genBtn.textContent = 'Generate Story';
+  const titleEl = document.getElementById('title');
+  const storyEl = document.getElementById('story');
+  titleEl.textContent = '';
+  storyEl.textContent = '';
+  document.getElementById('rawStory').value = '';
+  document.getElementById('story-card').classList.remove('hidden');
 
+  let data = null;
+  try {
+    const res = await fetch('/generate', {
+      method:'POST',
+      headers:{'Content-Type':'application/json', 'Accept':'text/event-stream'},
+      body: JSON.stringify({ inspiration, tone })
+    });
+    if(!res.ok){
+      // Validation errors and proxy failures arrive as JSON/HTML, not a stream
+      data = { error: 'Request failed (' + res.status + ')' };
+      try {
+        const body = await res.json();
+        if(body.error) data.error = body.error;
+        else if(body.detail) data.error = typeof body.detail === 'string' ? body.detail : JSON.stringify(body.detail);
+      } catch(e){}
+    } else {
+      const onDelta = storyStreamer(titleEl, storyEl);
+      await readEvents(res, (evt) => {
+        if(evt.delta) onDelta(evt.delta);
+        else data = evt;
+      });
+    }
+  } finally {
+    genBtn.disabled = false; genBtn.textContent = 'Generate Story';
+  }
+
+  if(!data){ alert('Connection closed before the story finished.'); return; }
   if(data.error){ alert(data.error); return; }
 
-  document.getElementById('title').textContent = data.title || '(untitled)';
-  document.getElementById('story').textContent = data.story_clean;
+  titleEl.textContent = data.title || '(untitled)';
+  storyEl.textContent = data.story_clean;
   document.getElementById('rawStory').value = data.story_raw;
-  document.getElementById('story-card').classList.remove('hidden');
+  storyId = data.story_id;
   window.scrollTo({ top: document.body.scrollHeight, behavior: 'smooth' });
 }
 
+function postRevise(body){
+  return fetch('/revise', {
+    method:'POST',
+    headers:{'Content-Type':'application/json'},
+    body: JSON.stringify(body)
+  });
+}
+
 async function reviseStory(){
   const feedback = document.getElementById('feedback').value.trim();
   const rawStory = document.getElementById('rawStory').value;
   if(!feedback){ alert('Tell me what to change.'); return; }
   reviseBtn.disabled = true; reviseBtn.textContent='Revising...';
 
-  const res = await fetch('/revise', {
-    method:'POST',
-    headers:{'Content-Type':'application/json'},
-    body: JSON.stringify({ feedback, original_story: rawStory })
-  });
+  // The server usually still has the story; only upload it when it doesn't
+  let res = storyId
+    ? await postRevise({ feedback, story_id: storyId })
+    : await postRevise({ feedback, original_story: rawStory });
+  if(res.status === 409) res = await postRevise({ feedback, original_story: rawStory });
   const data = await res.json();
   reviseBtn.disabled = false; reviseBtn.textContent='Apply Change';
 
@@ -144,6 +299,7 @@ async function reviseStory(){
   document.getElementById('title').textContent = data.title || '(untitled)';
   document.getElementById('story').textContent = data.story_clean;
   document.getElementById('rawStory').value = data.story_raw;
+  storyId = data.story_id;
   document.getElementById('feedback').value = '';
 }
 
@@ -154,6 +310,7 @@ function resetAll(){
   document.getElementById('title').textContent = '';
   document.getElementById('story').textContent = '';
   document.getElementById('rawStory').value = '';
+  storyId = null;
   window.scrollTo({ top: 0, behavior: 'smooth' });
 }
 
@@ -163,7 +320,23 @@ resetBtn.onclick = resetAll;
 </script>
 </body>
 </html>
-""")
+""").render()
+INDEX_BYTES = INDEX_HTML.encode("utf-8")
+INDEX_GZIP = gzip.compress(INDEX_BYTES)
+# Per-representation ETags sharing a content hash, so either one revalidates
+INDEX_HASH = hashlib.sha256(INDEX_BYTES).hexdigest()[:16]
+INDEX_ETAG = f'"{INDEX_HASH}"'
+INDEX_GZIP_ETAG = f'"{INDEX_HASH}-gzip"'
+
+# Responses are immutable once built, so GET / reuses these instead of
+# re-encoding the body and rebuilding headers per request
+_INDEX_HEADERS = {"Cache-Control": "public, max-age=300", "Vary": "Accept-Encoding"}
+INDEX_RESPONSE = HTMLResponse(INDEX_BYTES, headers={**_INDEX_HEADERS, "ETag": INDEX_ETAG})
+INDEX_GZIP_RESPONSE = HTMLResponse(
+    INDEX_GZIP, headers={**_INDEX_HEADERS, "ETag": INDEX_GZIP_ETAG, "Content-Encoding": "gzip"}
+)
+INDEX_NOT_MODIFIED = Response(status_code=304, headers={**_INDEX_HEADERS, "ETag": INDEX_ETAG})
+INDEX_GZIP_NOT_MODIFIED = Response(status_code=304, headers={**_INDEX_HEADERS, "ETag": INDEX_GZIP_ETAG})
 
 # ---- Pydantic Schemas ----
 class GenerateRequest(BaseModel):
@@ -172,83 +345,333 @@ class GenerateRequest(BaseModel):
 
 class ReviseRequest(BaseModel):
     feedback: str
-    original_story: str
+    # Clients send story_id; original_story is the fallback when this
+    # process no longer (or never did) hold that story
+    story_id: Optional[str] = None
+    original_story: Optional[str] = None
 
-# ---- Prompt Templates ----
-def story_prompt(inspiration: str, tone: str) -> str:
-    # Master storyteller prompt with enhanced narrative capabilities
-    return textwrap.dedent(f"""
-    You are a master storyteller with the ability to weave intricate narratives that captivate the imagination. Your expertise lies in crafting tales that feel as though they are plucked straight from the pages of a book, whether they are grounded in reality or tinged with fantasy.
+    @model_validator(mode="after")
+    def needs_a_story(self):
+        if not self.story_id and not self.original_story:
+            raise ValueError("Provide story_id or original_story")
+        return self
 
-    Your task is to tell a story based on the following prompt. Here are the details to consider:
-
-    Theme or genre: Based on the inspiration and tone provided
-    Main character(s): Create compelling, authentic characters with clear motivations
-    Setting: Vivid, immersive world-building that serves the story
-    Conflict or challenge: Meaningful obstacles that drive character growth
+# ---- Prompt Templates ----
+# The static instructions ride along as each model's system instruction, so
+# every request only carries its variable tail.
+STORY_INSTRUCTIONS = """
+You are a master storyteller with the ability to weave intricate narratives that captivate the imagination. Your expertise lies in crafting tales that feel as though they are plucked straight from the pages of a book, whether they are grounded in reality or tinged with fantasy.
+
+Your task is to tell a story based on the user's prompt. Here are the details to consider:
+
+Theme or genre: Based on the inspiration and tone provided
+Main character(s): Create compelling, authentic characters with clear motivations
+Setting: Vivid, immersive world-building that serves the story
+Conflict or challenge: Meaningful obstacles that drive character growth
+Desired tone: As given with the user's inspiration
+
+Keep in mind the need to create vivid imagery and emotional depth in your storytelling, ensuring that each character feels authentic and the plot flows seamlessly.
+
+Additional Requirements:
+- Length: ~600–800 words. Make it feel polished and intentional.
+- Structure: Clear beginning, middle, and resolution with natural story progression.
+- IMPORTANT: Insert bracket markers at major transitions to enable later editing, exactly like:
+    [TWIST1] ... (text continues) ...
+    [TWIST2] ... (text continues) ...
+  Keep these markers embedded only around transitions you'd reasonably rewrite later.
+- Consistency: Maintain character names, setting logic, and timeline continuity.
+- Emotional Resonance: Ensure the story connects with readers on an emotional level.
+- Output strictly in the following format:
+
+Title: <concise, evocative title>
+
+Story:
+<the full story body including [TWIST#] markers where appropriate>
+""".strip()
+
+REVISION_INSTRUCTIONS = """
+You will revise the user's story to implement their requested change(s) without breaking continuity.
+
+Instructions:
+- Read the user's feedback and adjust the most relevant transition(s) marked with [TWIST#].
+- Keep character names, setting facts, and tone consistent.
+- Prefer minimal rewrite: change the targeted transition plus any sentences needed for coherence.
+- Keep the [TWIST#] markers in place (they help future edits), but you may add or remove one if it improves structure.
+- Length should remain similar to the original (roughly 600–800 words).
+- Output strictly in the same format:
+
+Title: <title>
+
+Story:
+<full revised story body including [TWIST#] markers>
+""".strip()
+
+# Per-request tails, dedented once here rather than on every call
+STORY_TEMPLATE = textwrap.dedent("""
     Desired tone: {tone}
 
-    Keep in mind the need to create vivid imagery and emotional depth in your storytelling, ensuring that each character feels authentic and the plot flows seamlessly.
-
-    Additional Requirements:
-    - Length: ~600–800 words. Make it feel polished and intentional.
-    - Structure: Clear beginning, middle, and resolution with natural story progression.
-    - IMPORTANT: Insert bracket markers at major transitions to enable later editing, exactly like:
-        [TWIST1] ... (text continues) ...
-        [TWIST2] ... (text continues) ...
-      Keep these markers embedded only around transitions you'd reasonably rewrite later.
-    - Consistency: Maintain character names, setting logic, and timeline continuity.
-    - Emotional Resonance: Ensure the story connects with readers on an emotional level.
-    - Output strictly in the following format:
-
-    Title: <concise, evocative title>
-
-    Story:
-    <the full story body including [TWIST#] markers where appropriate>
-
     User inspiration: "{inspiration}"
     """)
 
-def revision_prompt(original_story: str, feedback: str) -> str:
-    return textwrap.dedent(f"""
-    You will revise the story below to implement the user's requested change(s) without breaking continuity.
-
-    Instructions:
-    - Read the user's feedback and adjust the most relevant transition(s) marked with [TWIST#].
-    - Keep character names, setting facts, and tone consistent.
-    - Prefer minimal rewrite: change the targeted transition plus any sentences needed for coherence.
-    - Keep the [TWIST#] markers in place (they help future edits), but you may add or remove one if it improves structure.
-    - Length should remain similar to the original (roughly 600–800 words).
-    - Output strictly in the same format:
-
-    Title: <title>
-
-    Story:
-    <full revised story body including [TWIST#] markers>
-
+REVISION_TEMPLATE = textwrap.dedent("""
     User feedback: "{feedback}"
 
     Original story:
     {original_story}
     """)
+
+def story_prompt(inspiration: str, tone: str) -> str:
+    return STORY_TEMPLATE.format(tone=tone, inspiration=inspiration)
+
+def revision_prompt(original_story: str, feedback: str) -> str:
+    return REVISION_TEMPLATE.format(feedback=feedback, original_story=original_story)
+
+# System instruction per prompt kind; each kind gets its own long-lived model
+PROMPT_INSTRUCTIONS = {
+    "story": STORY_INSTRUCTIONS,
+    "revision": REVISION_INSTRUCTIONS,
+}
+
+# ---- Key Pool ----
+class KeyPool:
+    """
+    Round-robin over the configured API keys. genai.configure() is process
+    global, so each key gets its own async client and model objects instead.
+    A key that hits its quota sits out KEY_COOLDOWN_SECONDS while the rest
+    carry the traffic.
+
+    Per-key clients are attached through GenerativeModel._async_client, a
+    private attribute of google-generativeai 0.7.2 (pinned in requirements.txt).
+    The constructor checks it is still there so an SDK bump fails at import
+    instead of silently using the unconfigured global client.
+    """
+    def __init__(self, api_keys: list[str]):
+        self.api_keys = api_keys
+        self._order = itertools.cycle(api_keys)
+        self._cooldown_until: dict[str, float] = {}
+        self._clients: dict[str, glm.GenerativeServiceAsyncClient] = {}
+        # Models carry their instructions and generation config from the start,
+        # so requests only send the variable prompt tail
+        self._models = {
+            (api_key, kind): genai.GenerativeModel(
+                MODEL_NAME,
+                system_instruction=instructions,
+                generation_config=GENERATION_CONFIG,
+            )
+            for api_key in api_keys
+            for kind, instructions in PROMPT_INSTRUCTIONS.items()
+        }
+        for model in self._models.values():
+            if getattr(model, "_async_client", object()) is not None:
+                raise RuntimeError(
+                    "GenerativeModel._async_client is missing; KeyPool relies on "
+                    "google-generativeai==0.7.2 internals, re-check it after upgrading"
+                )
+
+    def next_key(self) -> str:
+        now = time.monotonic()
+        for _ in self.api_keys:
+            api_key = next(self._order)
+            if self._cooldown_until.get(api_key, 0.0) <= now:
+                return api_key
+        # Every key is cooling down; use the one that recovers first
+        return min(self.api_keys, key=lambda k: self._cooldown_until.get(k, 0.0))
+
+    def cool_down(self, api_key: str):
+        self._cooldown_until[api_key] = time.monotonic() + KEY_COOLDOWN_SECONDS
+
+    def model(self, api_key: str, kind: str) -> genai.GenerativeModel:
+        model = self._models[(api_key, kind)]
+        if model._async_client is None:
+            # Attached on first use so the gRPC channel is created inside the running loop
+            client = self._clients.get(api_key)
+            if client is None:
+                # Same user agent genai.configure() would set up
+                client = glm.GenerativeServiceAsyncClient(
+                    client_options={"api_key": api_key},
+                    client_info=gapic_v1.client_info.ClientInfo(user_agent=f"genai-py/{genai.__version__}"),
+                )
+                self._clients[api_key] = client
+            model._async_client = client
+        return model
+
+key_pool = KeyPool(GEMINI_API_KEYS)
+
 # ---- Helpers ----
-def call_gemini(prompt: str) -> str:
+def gemini_error(e: Exception) -> Exception:
+    """Translate raw SDK errors into messages the UI can show"""
+    error_msg = str(e)
+    if "RATE_LIMIT_EXCEEDED" in error_msg or "429" in error_msg:
+        return Exception("API quota exceeded. Please check your Google AI Studio quota limits or try again later.")
+    elif "PERMISSION_DENIED" in error_msg or "403" in error_msg:
+        return Exception("API key doesn't have permission. Please check your API key in Google AI Studio.")
+    elif "INVALID_ARGUMENT" in error_msg or "400" in error_msg:
+        return Exception("Invalid API request. Please check your API key configuration.")
+    else:
+        return Exception(f"Gemini API error: {error_msg}")
+
+# Quota bumps and server hiccups are usually gone a second or two later
+TRANSIENT_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    google_exceptions.DeadlineExceeded,
+)
+
+@retry(
+    stop=stop_after_attempt(4),
+    wait=wait_exponential_jitter(initial=0.5, max=8),
+    retry=retry_if_exception_type(TRANSIENT_ERRORS),
+    reraise=True,
+)
+async def generate_with_retry(kind: str, prompt: str, stream: bool = False):
+    # With stream=True the SDK awaits the first chunk here, so a retry never
+    # replays text a client has already received. Each attempt takes the next
+    # key, so a quota hit on one key is retried on another.
+    api_key = key_pool.next_key()
+    try:
+        return await key_pool.model(api_key, kind).generate_content_async(prompt, stream=stream)
+    except google_exceptions.ResourceExhausted:
+        key_pool.cool_down(api_key)
+        raise
+
+_llm_slots: Optional[asyncio.Semaphore] = None
+
+def llm_slots() -> asyncio.Semaphore:
+    # Created on first use: before Python 3.10, asyncio primitives bind to
+    # whichever loop is current when they're constructed
+    global _llm_slots
+    if _llm_slots is None:
+        _llm_slots = asyncio.Semaphore(MAX_CONCURRENT_LLM)
+    return _llm_slots
+
+async def call_gemini(kind: str, prompt: str) -> str:
     """Call Gemini API with error handling and rate limiting awareness"""
     try:
-        # Single-turn generation for determinism & cheapness
-        resp = model.generate_content(prompt)
+        # Single-turn generation for determinism & cheapness; async so the
+        # event loop keeps serving other sessions while this one waits
+        async with llm_slots():
+            resp = await generate_with_retry(kind, prompt)
         # google-generativeai returns text in resp.text
         return (resp.text or "").strip()
     except Exception as e:
-        error_msg = str(e)
-        if "RATE_LIMIT_EXCEEDED" in error_msg or "429" in error_msg:
-            raise Exception("API quota exceeded. Please check your Google AI Studio quota limits or try again later.")
-        elif "PERMISSION_DENIED" in error_msg or "403" in error_msg:
-            raise Exception("API key doesn't have permission. Please check your API key in Google AI Studio.")
-        elif "INVALID_ARGUMENT" in error_msg or "400" in error_msg:
-            raise Exception("Invalid API request. Please check your API key configuration.")
-        else:
-            raise Exception(f"Gemini API error: {error_msg}")
+        raise gemini_error(e)
+
+async def stream_gemini(kind: str, prompt: str) -> AsyncIterator[str]:
+    """Yield Gemini output as it is generated instead of waiting for the whole story"""
+    try:
+        # Hold the slot until the stream ends; that's how long Gemini is busy
+        async with llm_slots():
+            resp = await generate_with_retry(kind, prompt, stream=True)
+            async for chunk in resp:
+                if chunk.parts:
+                    yield chunk.text
+    except Exception as e:
+        raise gemini_error(e)
+
+class SharedStream:
+    """
+    One Gemini stream fanned out to every request asking for the same story.
+    The producer runs as its own task, so a client disconnecting doesn't
+    cancel the generation other readers are still waiting on. `finish` turns
+    the complete text into `result` once, before readers see the end.
+    """
+    def __init__(self, source: AsyncIterator[str], finish: Callable[[str], Optional[dict]]):
+        self.chunks: list[str] = []
+        self.result: Optional[dict] = None
+        self.error: Optional[Exception] = None
+        self.done = False
+        self._changed = asyncio.Condition()
+        self.task = asyncio.create_task(self._pump(source, finish))
+
+    async def _pump(self, source: AsyncIterator[str], finish: Callable[[str], Optional[dict]]):
+        try:
+            async for text in source:
+                async with self._changed:
+                    self.chunks.append(text)
+                    self._changed.notify_all()
+            self.result = finish("".join(self.chunks))
+        except Exception as e:
+            self.error = e
+        finally:
+            async with self._changed:
+                self.done = True
+                self._changed.notify_all()
+
+    async def __aiter__(self):
+        # Late joiners replay what was already generated, then follow live
+        seen = 0
+        while True:
+            async with self._changed:
+                await self._changed.wait_for(lambda: seen < len(self.chunks) or self.done)
+                new = self.chunks[seen:]
+                finished = self.done
+            for text in new:
+                yield text
+            seen += len(new)
+            if finished:
+                if self.error:
+                    raise self.error
+                return
+
+# In-flight /generate streams, keyed by generation_key
+_inflight: dict[str, SharedStream] = {}
+
+def generation_key(inspiration: str, tone: str) -> str:
+    return hashlib.blake2b(f"{tone}|{inspiration.strip().lower()}".encode()).hexdigest()
+
+def shared_story_stream(key: str, prompt: str) -> SharedStream:
+    """Join the in-flight generation for this key, or start one"""
+    stream = _inflight.get(key)
+    if stream is None:
+        stream = SharedStream(stream_gemini("story", prompt), lambda text: finish_story(key, text))
+        _inflight[key] = stream
+        stream.task.add_done_callback(lambda _: _inflight.pop(key, None))
+    return stream
+
+def finish_story(key: str, text: str) -> Optional[dict]:
+    # Runs once per generation, even if every reader has disconnected
+    out = text.strip()
+    if not out:
+        return None
+    story = story_payload(out)
+    story_cache.put(key, story)
+    return story
+
+class LRUCache:
+    """Bounded in-process map; each worker has its own, so misses are expected"""
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._items: "OrderedDict[str, object]" = OrderedDict()
+
+    def get(self, key: str):
+        value = self._items.get(key)
+        if value is not None:
+            self._items.move_to_end(key)
+        return value
+
+    def put(self, key: str, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+# generation_key -> finished /generate payload
+story_cache = LRUCache(STORY_CACHE_SIZE)
+# story_id -> story_raw
+story_store = LRUCache(STORY_STORE_SIZE)
+
+def remember_story(story_raw: str) -> str:
+    # Content-addressed, so entries never change under a client that holds the id
+    story_id = hashlib.blake2b(story_raw.encode(), digest_size=16).hexdigest()
+    story_store.put(story_id, story_raw)
+    return story_id
+
+_PARSE_RE = re.compile(
+    r"(?:^[ \t]*title:[ \t]*(?P<title>[^\n]*).*?)?^[ \t]*story:[^\n]*\n?(?P<story>.*)",
+    re.IGNORECASE | re.MULTILINE | re.DOTALL,
+)
+_TITLE_RE = re.compile(r"^[ \t]*title:[ \t]*(?P<title>[^\n]*)", re.IGNORECASE | re.MULTILINE)
 
 def parse_gemini_output(text: str) -> tuple[str, str]:
     """
@@ -258,65 +681,87 @@ def parse_gemini_output(text: str) -> tuple[str, str]:
       ...
     Returns (title, story_raw).
     """
-    title = ""
-    story = ""
-
     # Very lightweight parsing; model is instructed to follow this format
-    lines = text.splitlines()
-    mode = None
-    for ln in lines:
-        if ln.strip().lower().startswith("title:"):
-            title = ln.split(":", 1)[1].strip()
-            mode = None
-            continue
-        if ln.strip().lower().startswith("story:"):
-            mode = "story"
-            continue
-        if mode == "story":
-            story += ln + "\n"
-
-    # Clean trailing
-    story = story.strip()
-    return title, story
+    m = _PARSE_RE.search(text)
+    if not m:
+        # No Story: line at all; keep any title and treat the rest as the story
+        t = _TITLE_RE.search(text)
+        return (t["title"].strip() if t else ""), text.strip()
+    return (m["title"] or "").strip(), m["story"].strip()
+
+_TWIST_RE = re.compile(r"\[TWIST\d+\]")
 
 def strip_markers(story: str) -> str:
     # Show a clean story to readers; keep the raw version (with markers) hidden for surgical edits
-    return story.replace("[TWIST1]", "").replace("[TWIST2]", "").replace("[TWIST3]", "").replace("[TWIST4]", "").strip()
+    return _TWIST_RE.sub("", story).strip()
+
+def story_payload(out: str) -> dict:
+    title, story_raw = parse_gemini_output(out)
+    if not story_raw:
+        # Fallback: treat everything as story if format missed
+        story_raw = out
+    story_clean = strip_markers(story_raw)
+    return {
+        "title": title,
+        "story_id": remember_story(story_raw),
+        "story_raw": story_raw,
+        "story_clean": story_clean,
+    }
+
+def sse(payload: dict) -> bytes:
+    # One Server-Sent Events frame; orjson output never spans lines
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
 
 # ---- Routes ----
 @app.get("/", response_class=HTMLResponse)
-async def index(_: Request):
-    return INDEX_HTML.render()
+async def index(request: Request):
+    gzipped = "gzip" in request.headers.get("accept-encoding", "")
+    if INDEX_HASH in request.headers.get("if-none-match", ""):
+        return INDEX_GZIP_NOT_MODIFIED if gzipped else INDEX_NOT_MODIFIED
+    return INDEX_GZIP_RESPONSE if gzipped else INDEX_RESPONSE
 
 @app.post("/generate")
 async def generate(req: GenerateRequest):
-    try:
-        prompt = story_prompt(req.inspiration, req.tone)
-        out = call_gemini(prompt)
-        if not out:
-            return JSONResponse({"error": "Empty response from model"}, status_code=500)
-
-        title, story_raw = parse_gemini_output(out)
-        if not story_raw:
-            # Fallback: treat everything as story if format missed
-            story_raw = out
-        story_clean = strip_markers(story_raw)
-        return {"title": title, "story_raw": story_raw, "story_clean": story_clean}
-    except Exception as e:
-        return JSONResponse({"error": f"{type(e).__name__}: {e}"}, status_code=500)
+    key = generation_key(req.inspiration, req.tone)
+    prompt = story_prompt(req.inspiration, req.tone)
+
+    async def event_stream():
+        # Status is already 200 once streaming starts, so errors travel as frames
+        hit = story_cache.get(key)
+        if hit is not None:
+            story_store.put(hit["story_id"], hit["story_raw"])
+            yield sse(hit)
+            return
+
+        stream = shared_story_stream(key, prompt)
+        try:
+            async for text in stream:
+                yield sse({"delta": text})
+            if stream.result is None:
+                yield sse({"error": "Empty response from model"})
+                return
+            yield sse(stream.result)
+        except Exception as e:
+            yield sse({"error": f"{type(e).__name__}: {e}"})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 @app.post("/revise")
 async def revise(req: ReviseRequest):
+    original_story = (req.story_id and story_store.get(req.story_id)) or req.original_story
+    if not original_story:
+        # Only reachable with a story_id this process doesn't hold; the client retries with original_story
+        return ORJSONResponse({"error": "Unknown story_id", "code": "unknown_story"}, status_code=409)
     try:
-        prompt = revision_prompt(req.original_story, req.feedback)
-        out = call_gemini(prompt)
+        prompt = revision_prompt(original_story, req.feedback)
+        out = await call_gemini("revision", prompt)
         if not out:
-            return JSONResponse({"error": "Empty response from model"}, status_code=500)
+            return ORJSONResponse({"error": "Empty response from model"}, status_code=500)
 
-        title, story_raw = parse_gemini_output(out)
-        if not story_raw:
-            story_raw = out
-        story_clean = strip_markers(story_raw)
-        return {"title": title, "story_raw": story_raw, "story_clean": story_clean}
+        return story_payload(out)
     except Exception as e:
-        return JSONResponse({"error": f"{type(e).__name__}: {e}"}, status_code=500)
+        return ORJSONResponse({"error": f"{type(e).__name__}: {e}"}, status_code=500)